@@ -13,42 +13,59 @@ from pytorch_lightning.utilities.rank_zero import rank_zero_only
 from torch.nn import functional as F
 from torch.utils import data
 
-from dataset import SampleDataset
+from dataset import SampleDataset, CudaStreamPrefetcher
+from export import export_onnx, build_trt_engine, TRTRunner
 
 # Define the noise schedule and sampling loop
-def get_alphas_sigmas(t):
+def get_crash_alphas_sigmas(t):
     """Returns the scaling factors for the clean image (alpha) and for the
-    noise (sigma), given a timestep."""
-    return torch.cos(t * math.pi / 2), torch.sin(t * math.pi / 2)
-
-def get_crash_schedule(t):
+    noise (sigma) of the crash schedule, given a uniform timestep."""
     sigma = torch.sin(t * math.pi / 2) ** 2
     alpha = (1 - sigma ** 2) ** 0.5
-    return alpha_sigma_to_t(alpha, sigma)
+    return alpha, sigma
 
 def alpha_sigma_to_t(alpha, sigma):
     """Returns a timestep, given the scaling factors for the clean image and for
     the noise."""
     return torch.atan2(sigma, alpha) / math.pi * 2
 
+@torch.compile
+def make_noised(reals, alphas, sigmas):
+    """Returns the noised inputs and the velocity targets for a batch, fused
+    into a single kernel."""
+    noise = torch.randn_like(reals)
+    return reals * alphas + noise * sigmas, noise * alphas - reals * sigmas
+
 
 @torch.no_grad()
 def sample(model, x, steps, eta):
     """Draws samples from a model given starting noise."""
     ts = x.new_ones([x.shape[0]])
 
-    # Create the noise schedule
-    t = torch.linspace(1, 0, steps + 1)[:-1]
+    # Create the noise schedule on the sampling device once, so the loop below
+    # only indexes device tensors
+    t = torch.linspace(1, 0, steps + 1, device=x.device)[:-1]
 
-    t = get_crash_schedule(t)
+    alphas, sigmas = get_crash_alphas_sigmas(t)
+    t = alpha_sigma_to_t(alphas, sigmas)
 
-    alphas, sigmas = get_alphas_sigmas(t)
+    # If eta > 0, adjust the scaling factor for the predicted noise
+    # downward according to the amount of additional noise to add
+    ddim_sigma = eta * (sigmas[1:]**2 / sigmas[:-1]**2).sqrt() * \
+        (1 - alphas[:-1]**2 / alphas[1:]**2).sqrt()
+    adjusted_sigma = (sigmas[1:]**2 - ddim_sigma**2).sqrt()
+
+    # Reused for the fresh noise of every step
+    noise_buf = torch.empty_like(x)
 
     # The sampling loop
     for i in trange(steps):
 
         # Get the model output (v, the predicted velocity)
-        with torch.cuda.amp.autocast():
+        # The autocast weight cache is not allowed under CUDA graph capture
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, cache_enabled=False):
+            # Kept in fp32: the 0-d schedule tensors below would not promote a
+            # bf16 v, so every step of the recurrence would round to bf16
             v = model(x, ts * t[i]).float()
 
         # Predict the noise and the denoised image
@@ -58,19 +75,13 @@ def sample(model, x, steps, eta):
         # If we are not on the last timestep, compute the noisy image for the
         # next timestep.
         if i < steps - 1:
-            # If eta > 0, adjust the scaling factor for the predicted noise
-            # downward according to the amount of additional noise to add
-            ddim_sigma = eta * (sigmas[i + 1]**2 / sigmas[i]**2).sqrt() * \
-                (1 - alphas[i]**2 / alphas[i + 1]**2).sqrt()
-            adjusted_sigma = (sigmas[i + 1]**2 - ddim_sigma**2).sqrt()
-
             # Recombine the predicted noise and predicted denoised image in the
             # correct proportions for the next step
-            x = pred * alphas[i + 1] + eps * adjusted_sigma
+            x = pred * alphas[i + 1] + eps * adjusted_sigma[i]
 
             # Add the correct amount of fresh noise
             if eta:
-                x += torch.randn_like(x) * ddim_sigma
+                x.addcmul_(noise_buf.normal_(), ddim_sigma[i])
 
     # If we are on the last timestep, output the denoised image
     return pred
@@ -82,31 +93,68 @@ class DiffusionUncond(pl.LightningModule):
 
         self.diffusion = DiffusionAttnUnet1D(configs["latent_dim"], io_channels=2, n_attn_layers=4)
         self.diffusion_ema = deepcopy(self.diffusion)
+
+        # Compile in place so state_dict keys are unchanged; the input shapes are
+        # fixed by the config so the captured CUDA graphs are reused every step.
+        # The EMA model is only used for demos, which capture their own graph
+        self.diffusion.compile(mode="reduce-overhead", fullgraph=False)
         self.rng = torch.quasirandom.SobolEngine(1, scramble=True, seed=configs["seed"])
         self.ema_decay = configs["ema_decay"]
+        self.offload_ema = configs["offload_ema"]
+
+        # Pre-drawn Sobol timesteps, consumed a batch at a time
+        self.sobol_cache_size = 4096
+        self._sobol_cache = self._draw_sobol_cache()
+        self._sobol_index = 0
+
+    def _draw_sobol_cache(self):
+        cache = self.rng.draw(self.sobol_cache_size)[:, 0]
+        return cache.pin_memory() if torch.cuda.is_available() else cache
+
+    def draw_timesteps(self, n):
+        """Returns n quasirandom timesteps on the module's device."""
+        if self._sobol_index + n > self._sobol_cache.shape[0]:
+            self._sobol_cache = self._draw_sobol_cache()
+            self._sobol_index = 0
+        t = self._sobol_cache[self._sobol_index:self._sobol_index + n]
+        self._sobol_index += n
+        return t.to(self.device, non_blocking=True)
         
+    def offload_ema_to_cpu(self):
+        """Moves the EMA model to pinned CPU memory, since it is only needed on
+        the GPU while sampling demos."""
+        self.diffusion_ema.cpu()
+        if torch.cuda.is_available():
+            for tensor in [*self.diffusion_ema.parameters(), *self.diffusion_ema.buffers()]:
+                tensor.data = tensor.data.pin_memory()
+
+    def on_fit_start(self):
+        if self.offload_ema:
+            self.offload_ema_to_cpu()
+
     def configure_optimizers(self):
-        return optim.Adam([*self.diffusion.parameters()], lr=4e-5)
+        # A single fused kernel updates every parameter on CUDA
+        if torch.cuda.is_available():
+            return optim.Adam([*self.diffusion.parameters()], lr=4e-5, fused=True)
+        return optim.Adam([*self.diffusion.parameters()], lr=4e-5, foreach=True)
   
     def training_step(self, batch, batch_idx):
-        reals = batch[0]
+        reals = batch
 
         # Draw uniformly distributed continuous timesteps
-        t = self.rng.draw(reals.shape[0])[:, 0].to(self.device)
-
-        t = get_crash_schedule(t)
+        t = self.draw_timesteps(reals.shape[0])
 
-        # Calculate the noise schedule parameters for those timesteps
-        alphas, sigmas = get_alphas_sigmas(t)
+        # Calculate the noise schedule parameters for those timesteps, and the
+        # corresponding crash schedule timesteps the model is conditioned on
+        alphas, sigmas = get_crash_alphas_sigmas(t)
+        t = alpha_sigma_to_t(alphas, sigmas)
 
         # Combine the ground truth images and the noise
         alphas = alphas[:, None, None]
         sigmas = sigmas[:, None, None]
-        noise = torch.randn_like(reals)
-        noised_reals = reals * alphas + noise * sigmas
-        targets = noise * alphas - reals * sigmas
+        noised_reals, targets = make_noised(reals, alphas, sigmas)
 
-        with torch.cuda.amp.autocast():
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
             v = self.diffusion(noised_reals, t)
             mse_loss = F.mse_loss(v, targets)
             loss = mse_loss
@@ -119,6 +167,9 @@ class DiffusionUncond(pl.LightningModule):
         self.log_dict(log_dict, prog_bar=True, on_step=True)
         return loss
 
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer):
+        optimizer.zero_grad(set_to_none=True)
+
     def on_before_zero_grad(self, *args, **kwargs):
         decay = 0.95 if self.current_epoch < 25 else self.ema_decay
         ema_update(self.diffusion, self.diffusion_ema, decay)
@@ -137,6 +188,57 @@ class DemoCallback(pl.Callback):
         self.demo_steps = configs["demo_steps"]
         self.last_demo_step = -1
 
+        # Static input, output and graph for replaying the whole sampling loop
+        self._graph = None
+        self._x_static = None
+        self._fakes_static = None
+        self._noise = None
+
+    def _sample(self, module, noise):
+        """Runs sample() on the EMA model, captured into a CUDA graph on the
+        first call and replayed on later calls."""
+        if noise.device.type != 'cuda':
+            return sample(module.diffusion_ema, noise, self.demo_steps, 0)
+
+        # An offloaded EMA model is uploaded to fresh memory on every demo, which
+        # would invalidate a captured graph
+        if module.offload_ema:
+            module.diffusion_ema.to(module.device)
+            try:
+                return sample(module.diffusion_ema, noise, self.demo_steps, 0)
+            finally:
+                module.offload_ema_to_cpu()
+
+        model = module.diffusion_ema
+
+        if self._graph is None:
+            x_static = noise.clone()
+
+            try:
+                # Warm up on a side stream before capturing
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    sample(model, x_static, self.demo_steps, 0)
+                torch.cuda.current_stream().wait_stream(stream)
+
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph):
+                    fakes_static = sample(model, x_static, self.demo_steps, 0)
+            except Exception as e:
+                # Leave the callback uncaptured so the next demo retries, and
+                # sample this one eagerly
+                print(f'CUDA graph capture failed, sampling eagerly. {type(e).__name__}: {e}', file=sys.stderr)
+                return sample(model, noise, self.demo_steps, 0)
+
+            self._x_static = x_static
+            self._graph = graph
+            self._fakes_static = fakes_static
+
+        self._x_static.copy_(noise)
+        self._graph.replay()
+        return self._fakes_static.clone()
+
     @rank_zero_only
     @torch.no_grad()
     #def on_train_epoch_end(self, trainer, module):
@@ -147,10 +249,12 @@ class DemoCallback(pl.Callback):
         
         self.last_demo_step = trainer.global_step
     
-        noise = torch.randn([self.num_demos, 2, self.demo_samples]).to(module.device)
+        if self._noise is None:
+            self._noise = torch.empty([self.num_demos, 2, self.demo_samples], device=module.device)
+        noise = self._noise.normal_()
 
         try:
-            fakes = sample(module.diffusion_ema, noise, self.demo_steps, 0)
+            fakes = self._sample(module, noise)
             print(fakes.shape)
 
             # Put the demos together
@@ -185,16 +289,27 @@ def main():
     print("Using Device: ", device)
     torch.manual_seed(configs["seed"])
 
+    # Input shapes are fixed by sample_size and batch_size, so let cuDNN pick the
+    # fastest Conv1d algorithm once and allow TF32 matmuls
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
     train_set = SampleDataset(configs["training_dir"])
     train_dl = data.DataLoader(
         train_set, 
         configs["batch_size"], 
         shuffle=True, 
         num_workers=configs["num_workers"],
-        persistent_workers=True,
-        pin_memory=True
+        persistent_workers=configs["num_workers"] > 0,
+        pin_memory=True,
+        drop_last=True
     )
 
+    # Overlap host to device copies with compute on a single GPU
+    if device.type == "cuda" and configs["num_gpus"] == 1:
+        train_dl = CudaStreamPrefetcher(train_dl, device)
+
     exc_callback = ExceptionCallback()
     ckpt_callback = pl.callbacks.ModelCheckpoint(every_n_train_steps=configs["checkpoint_every"], save_top_k=-1, dirpath=save_path)
     demo_callback = DemoCallback(configs)
@@ -204,7 +319,7 @@ def main():
     diffusion_trainer = pl.Trainer(
         devices=configs["num_gpus"],
         accelerator="gpu",
-        precision=16,
+        precision='bf16-mixed',
         accumulate_grad_batches=configs["accum_batches"],
         callbacks=[ckpt_callback, demo_callback, exc_callback],
         max_epochs=100
@@ -214,6 +329,16 @@ def main():
 
     diffusion_trainer.fit(diffusion_model, train_dl)
 
+    # Optionally export the EMA model and sample from a TensorRT engine
+    if configs["export_trt"] and diffusion_trainer.is_global_zero:
+        export_onnx(diffusion_model.diffusion_ema, configs["onnx_path"], configs["sample_size"])
+        build_trt_engine(configs["onnx_path"], configs["trt_engine_path"], configs["sample_size"], configs["num_demos"])
+
+        runner = TRTRunner(configs["trt_engine_path"], device)
+        noise = torch.randn([configs["num_demos"], 2, configs["sample_size"]], device=device)
+        fakes = sample(runner, noise, configs["demo_steps"], 0)
+        print(fakes.shape)
+
 if __name__ == '__main__':
     main()
 
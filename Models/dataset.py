@@ -13,13 +13,53 @@ import numpy as np
 class SampleDataset(torch.utils.data.Dataset):
   def __init__(self, data_path):
     super().__init__()
-    data = np.load(data_path)
-    self.data = torch.from_numpy(data)
+    # Memory map the array so it is paged in while filling the tensor below,
+    # rather than held in memory alongside it
+    data = np.load(data_path, mmap_mode='c')
+    # Duplicate to stereo once, instead of per item. Kept in fp32 so batches pin
+    # reliably; autocast handles the downcast on device. Workers read the same
+    # shared buffer instead of receiving a pickled copy
+    source = torch.from_numpy(data)
+    if source.ndim == 2:
+      source = source.unsqueeze(1)
+    self.data = torch.empty([data.shape[0], 2, data.shape[-1]]).share_memory_()
+    self.data.copy_(source)
 
   def __len__(self):
     return self.data.shape[0]
 
   def __getitem__(self, idx):
-    out = self.data[idx].repeat(2, 1)
-    out = out.type(torch.HalfTensor)
-    return (out, idx)
\ No newline at end of file
+    return self.data[idx]
+
+class CudaStreamPrefetcher:
+  """Wraps a DataLoader and copies the next batch to the GPU on a side stream
+  while the current batch is being trained on."""
+  def __init__(self, loader, device):
+    self.loader = loader
+    self.device = device
+
+  def __len__(self):
+    return len(self.loader)
+
+  def _preload(self, loader, stream):
+    batch = next(loader, None)
+    if batch is None:
+      return None, None
+    with torch.cuda.stream(stream):
+      batch = batch.to(self.device, non_blocking=True)
+      ready = torch.cuda.Event()
+      ready.record(stream)
+    return batch, ready
+
+  def __iter__(self):
+    stream = torch.cuda.Stream(self.device)
+    loader = iter(self.loader)
+    batch, ready = self._preload(loader, stream)
+    while batch is not None:
+      current_stream = torch.cuda.current_stream(self.device)
+      current_stream.wait_event(ready)
+      # The batch was allocated on the copy stream but is used on this one
+      batch.record_stream(current_stream)
+      next_batch, next_ready = self._preload(loader, stream)
+      yield batch
+      batch, ready = next_batch, next_ready
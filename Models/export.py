@@ -0,0 +1,78 @@
+import torch
+
+
+def export_onnx(model, path, sample_size, io_channels=2):
+    """Exports a diffusion model to ONNX with a dynamic batch dimension."""
+    device = next(model.parameters()).device
+    dummy_x = torch.randn([1, io_channels, sample_size], device=device)
+    dummy_t = torch.ones([1], device=device)
+
+    torch.onnx.export(
+        model,
+        (dummy_x, dummy_t),
+        path,
+        input_names=['x', 't'],
+        output_names=['v'],
+        opset_version=17,
+        dynamic_axes={'x': {0: 'batch'}, 't': {0: 'batch'}, 'v': {0: 'batch'}}
+    )
+
+
+def build_trt_engine(onnx_path, engine_path, sample_size, max_batch, io_channels=2):
+    """Builds a reduced precision TensorRT engine from an exported ONNX model
+    and writes it to engine_path."""
+    import tensorrt as trt
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+
+    if not parser.parse_from_file(onnx_path):
+        errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+        raise RuntimeError('Failed to parse ONNX model: ' + '; '.join(errors))
+
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.FP16)
+    if hasattr(trt.BuilderFlag, 'BF16'):
+        config.set_flag(trt.BuilderFlag.BF16)
+
+    profile = builder.create_optimization_profile()
+    profile.set_shape('x', [1, io_channels, sample_size], [max_batch, io_channels, sample_size],
+                      [max_batch, io_channels, sample_size])
+    profile.set_shape('t', [1], [max_batch], [max_batch])
+    config.add_optimization_profile(profile)
+
+    serialized = builder.build_serialized_network(network, config)
+    if serialized is None:
+        raise RuntimeError('Failed to build TensorRT engine')
+
+    with open(engine_path, 'wb') as file:
+        file.write(serialized)
+
+
+class TRTRunner:
+    """Runs a TensorRT engine built by build_trt_engine. It is called like the
+    diffusion model, so it can be passed to sample() in its place."""
+
+    def __init__(self, engine_path, device='cuda'):
+        import tensorrt as trt
+
+        self.device = torch.device(device)
+        logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, 'rb') as file:
+            self.engine = trt.Runtime(logger).deserialize_cuda_engine(file.read())
+        self.context = self.engine.create_execution_context()
+
+    def __call__(self, x, t):
+        x = x.float().contiguous()
+        t = t.float().contiguous()
+        v = torch.empty_like(x)
+
+        self.context.set_input_shape('x', tuple(x.shape))
+        self.context.set_input_shape('t', tuple(t.shape))
+        self.context.set_tensor_address('x', x.data_ptr())
+        self.context.set_tensor_address('t', t.data_ptr())
+        self.context.set_tensor_address('v', v.data_ptr())
+        self.context.execute_async_v3(torch.cuda.current_stream(self.device).cuda_stream)
+        return v
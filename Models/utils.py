@@ -45,8 +45,19 @@ def ema_update(model, averaged_model, decay):
     averaged_params = dict(averaged_model.named_parameters())
     assert model_params.keys() == averaged_params.keys()
 
-    for name, param in model_params.items():
-        averaged_params[name].mul_(decay).add_(param, alpha=1 - decay)
+    names = list(model_params.keys())
+    averaged = [averaged_params[name] for name in names]
+    # Match the averaged device and dtype, so the EMA weights stay in full
+    # precision and may be kept offloaded to the CPU
+    current = [model_params[name].to(averaged_params[name].device, averaged_params[name].dtype,
+                                     non_blocking=True) for name in names]
+    cuda_to_host = [model_params[name].device for name in names
+                    if model_params[name].is_cuda and not averaged_params[name].is_cuda]
+    if cuda_to_host:
+        # Wait once for all of the non-blocking device to host copies
+        torch.cuda.current_stream(cuda_to_host[0]).synchronize()
+    torch._foreach_mul_(averaged, decay)
+    torch._foreach_add_(averaged, current, alpha=1 - decay)
 
     model_buffers = dict(model.named_buffers())
     averaged_buffers = dict(averaged_model.named_buffers())